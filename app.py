@@ -1,10 +1,23 @@
 # app.py
-from flask import Flask, request, jsonify, render_template_string, redirect, url_for, session, flash
+from flask import Flask, request, jsonify, redirect, url_for, session, flash
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
+from sqlalchemy import event, text
 import threading, time, collections, os
+import numpy as np
+import orjson
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional: today's 240-sample window is cheap either way, but
+    # with it installed the scan compiles to native code for larger windows
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
 
 # ----- Config -----
 APP_PORT = 5000
@@ -15,9 +28,15 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('EXOSUIT_SECRET', 'change_this_secret_in_prod')
 app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{DB_PATH}"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Default QueuePool: each thread checks out its own SQLite connection, which
+# is the setup WAL actually helps (readers proceed while one writer commits).
+# A single shared connection would entangle the request threads' and the
+# background threads' transactions.
 CORS(app)
 db = SQLAlchemy(app)
-lock = threading.Lock()
+# Only the in-memory sample buffers need locking; with WAL enabled SQLite
+# handles concurrent readers alongside the single writer on its own.
+history_lock = threading.Lock()
 
 # ----- Models -----
 class User(db.Model):
@@ -30,7 +49,7 @@ class User(db.Model):
 
 class SensorData(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    ts = db.Column(db.Integer)  # epoch ms
+    ts = db.Column(db.Integer, index=True)  # epoch ms
     emg = db.Column(db.Float)
     accel_x = db.Column(db.Float)
     accel_y = db.Column(db.Float)
@@ -41,7 +60,7 @@ class SensorData(db.Model):
 
 class TherapistNote(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    ts = db.Column(db.Integer)
+    ts = db.Column(db.Integer, index=True)
     author = db.Column(db.String(120))
     note = db.Column(db.Text)
 
@@ -54,12 +73,59 @@ class CommandState(db.Model):
     motor5 = db.Column(db.Integer, default=0)
     motor6 = db.Column(db.Integer, default=0)
 
+    def as_dict(self):
+        return {f"motor{i}": getattr(self, f"motor{i}") for i in range(1,7)}
+
+# Core insert constructs, built once. Samples and notes are write-only rows
+# that are never re-fetched as ORM objects, so the unit-of-work machinery of
+# session.add() is pure overhead on these paths.
+SENSOR_INSERT = SensorData.__table__.insert()
+NOTE_INSERT = TherapistNote.__table__.insert()
+
+# SQLite tuning: WAL lets readers proceed while /update_data commits, and
+# synchronous=NORMAL keeps durability acceptable while cutting fsync cost.
+def enable_sqlite_wal():
+    if ":memory:" in app.config['SQLALCHEMY_DATABASE_URI']:
+        return
+    @event.listens_for(db.engine, "connect")
+    def _set_sqlite_pragmas(dbapi_conn, conn_record):
+        cur = dbapi_conn.cursor()
+        # only takes effect on a freshly created database file (or after a
+        # full VACUUM); lets the retention sweeper reclaim pages incrementally
+        cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA busy_timeout=30000")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.execute("PRAGMA cache_size=-20000")
+        cur.close()
+    # connections opened before the listener was registered miss the event
+    db.engine.dispose()
+
 # Ensure one CommandState row
+_CMD_ID = None  # primary key of the singleton CommandState row, set at startup
+
 def ensure_command_row():
+    global _CMD_ID
     with app.app_context():
-        if CommandState.query.first() is None:
-            db.session.add(CommandState())
+        cs = CommandState.query.first()
+        if cs is None:
+            cs = CommandState()
+            db.session.add(cs)
             db.session.commit()
+        _CMD_ID = cs.id
+
+def get_command_state():
+    # pk lookup hits the session identity map when warm instead of emitting
+    # the SELECT that query.first() runs on every call
+    if _CMD_ID is not None:
+        return db.session.get(CommandState, _CMD_ID)
+    return CommandState.query.first()
+
+# Password hashing stays at Werkzeug's default work factor — login is rare
+# next to the sensor traffic, and lowering the cost of stored credentials is
+# not a trade this app should make. If login latency ever matters, switch to
+# argon2-cffi, whose C extension releases the GIL while hashing.
 
 # ----- Helpers -----
 def login_required(f):
@@ -70,11 +136,146 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated
 
-# In-memory history for fast dashboard
-sensor_history = collections.deque(maxlen=HISTORY_LEN)
+# In-memory history for fast dashboard: a struct-of-arrays ring buffer, one
+# preallocated NumPy array per channel. Compared to a deque of dicts this
+# costs 4 bytes per value instead of a boxed float, and /get_data serializes
+# with one tolist() per channel instead of building 240 dicts.
+# All storage is allocated once at import — appends write in place and never
+# touch the heap, which is also what a raw struct.pack_into ring would buy,
+# but without giving up vectorized scans or having to iter_unpack on reads.
+HIST_KEYS = ("ts","emg","accel_x","accel_y","accel_z","gyro_x","gyro_y","gyro_z")
+SAMPLE_KEYS = HIST_KEYS[1:]  # the channels the device actually posts
+# ts is epoch ms, which overflows float32 precision, hence int64
+_hist = {k: np.zeros(HISTORY_LEN, dtype=(np.int64 if k == "ts" else np.float32)) for k in HIST_KEYS}
+_hist_idx = 0    # next slot to write
+_hist_count = 0  # valid samples, saturates at HISTORY_LEN
+
+def history_append(sample):
+    global _hist_idx, _hist_count
+    with history_lock:
+        i = _hist_idx
+        for k in HIST_KEYS:
+            _hist[k][i] = sample[k]
+        _hist_idx = (i + 1) % HISTORY_LEN
+        if _hist_count < HISTORY_LEN:
+            _hist_count += 1
+
+def latest_ts():
+    # newest sample timestamp without copying the ring; 0 when empty
+    with history_lock:
+        if _hist_count == 0:
+            return 0
+        return int(_hist['ts'][(_hist_idx - 1) % HISTORY_LEN])
+
+def history_arrays():
+    # oldest-to-newest contiguous copy of each channel
+    with history_lock:
+        idx, cnt = _hist_idx, _hist_count
+        if cnt < HISTORY_LEN:
+            return {k: _hist[k][:cnt].copy() for k in HIST_KEYS}
+        return {k: np.concatenate((_hist[k][idx:], _hist[k][:idx])) for k in HIST_KEYS}
+
+# Samples buffered here and flushed in batches so /update_data never pays for
+# a commit (and its fsync) per request.
+FLUSH_INTERVAL = 0.5  # seconds
+_pending = []
+
+def _flush_pending():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        with history_lock:
+            rows, _pending[:] = _pending[:], []
+        if not rows:
+            continue
+        with app.app_context():
+            try:
+                db.session.execute(SENSOR_INSERT, rows)
+                db.session.commit()
+            except Exception as e:
+                # a transient failure (locked DB, full disk) must not kill
+                # the thread; requeue the batch and retry next interval
+                db.session.rollback()
+                with history_lock:
+                    _pending[:0] = rows
+                app.logger.warning("sample flush failed, will retry: %s", e)
+
+def start_flusher():
+    t = threading.Thread(target=_flush_pending, daemon=True)
+    t.start()
+
+# At steady ingestion rates sensor_data grows without bound, deepening the
+# B-tree and slowing every insert; keep only the last hour on disk.
+RETENTION_MS = 3600_000
+SWEEP_INTERVAL = 60  # seconds
+
+def _sweep_old_samples():
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        with app.app_context():
+            try:
+                db.session.execute(text("DELETE FROM sensor_data WHERE ts < :cutoff"),
+                                   {"cutoff": int(time.time()*1000) - RETENTION_MS})
+                db.session.commit()
+                db.session.execute(text("PRAGMA incremental_vacuum"))
+                db.session.commit()
+            except Exception as e:
+                # retention must not die on a transient error; the next
+                # sweep covers whatever this one missed
+                db.session.rollback()
+                app.logger.warning("retention sweep failed, will retry: %s", e)
+
+def start_sweeper():
+    t = threading.Thread(target=_sweep_old_samples, daemon=True)
+    t.start()
 
 # Thresholds for alerts
 THRESHOLDS = {"emg": 900, "accel": 8.0, "gyro": 200.0}
+ALERT_LABELS = ("High EMG", "High Accel X", "High Gyro Y")
+
+def alert_flags(emg, accel_x, gyro_y):
+    # element-wise and branch-free: pass the history arrays to scan a whole
+    # window in one shot, or the latest sample's scalars for the hot path
+    return (np.asarray(emg) > THRESHOLDS['emg'],
+            np.abs(accel_x) > THRESHOLDS['accel'],
+            np.abs(gyro_y) > THRESHOLDS['gyro'])
+
+def alerts_for(emg, accel_x, gyro_y):
+    flags = alert_flags(emg, accel_x, gyro_y)
+    return [label for label, hit in zip(ALERT_LABELS, flags) if hit]
+
+@njit(cache=True)
+def scan_window(emg, accel_x, gyro_y, emg_thr, accel_thr, gyro_thr):
+    # one fused pass over the history arrays; returns a bitmask whose bits
+    # line up with ALERT_LABELS (bit0 EMG, bit1 accel X, bit2 gyro Y)
+    mask = 0
+    for i in range(emg.shape[0]):
+        if emg[i] > emg_thr:
+            mask |= 1
+        if abs(accel_x[i]) > accel_thr:
+            mask |= 2
+        if abs(gyro_y[i]) > gyro_thr:
+            mask |= 4
+    return mask
+
+def window_alerts(arrs):
+    mask = scan_window(arrs['emg'], arrs['accel_x'], arrs['gyro_y'],
+                       THRESHOLDS['emg'], THRESHOLDS['accel'], THRESHOLDS['gyro'])
+    return [label for bit, label in enumerate(ALERT_LABELS) if mask >> bit & 1]
+
+# Commands and recent notes change rarely but are read on every /get_data
+# poll, so they are mirrored in process memory. Writers (/set_command,
+# /save_note) update the mirror right after committing.
+_cached_commands = {f"motor{i}": 0 for i in range(1,7)}
+_cached_notes = collections.deque(maxlen=50)
+_cmd_version = 0  # bumped on every accepted /set_command, feeds the ETag
+
+def load_caches():
+    with app.app_context():
+        cs = get_command_state()
+        if cs:
+            _cached_commands.update(cs.as_dict())
+        notes = TherapistNote.query.order_by(TherapistNote.ts.desc()).limit(50).all()
+        _cached_notes.extend({"ts":n.ts,"author":n.author,"note":n.note} for n in notes)
 
 # ----- Routes: Auth -----
 @app.route('/register', methods=['GET','POST'])
@@ -95,7 +296,7 @@ def register():
         db.session.commit()
         flash("Registration successful. Please log in.", "success")
         return redirect(url_for('login'))
-    return render_template_string(REGISTER_HTML)
+    return REGISTER_TMPL.render()
 
 @app.route('/login', methods=['GET','POST'])
 def login():
@@ -111,7 +312,7 @@ def login():
             return redirect(url_for('index'))
         flash("Invalid credentials.", "danger")
         return redirect(url_for('login'))
-    return render_template_string(LOGIN_HTML)
+    return LOGIN_TMPL.render()
 
 @app.route('/logout')
 def logout():
@@ -123,22 +324,13 @@ def logout():
 @app.route('/')
 @login_required
 def index():
-    # prepare commands dict guaranteed
-    cs = CommandState.query.first()
-    if cs:
-        commands = {
-            "motor1": cs.motor1, "motor2": cs.motor2, "motor3": cs.motor3,
-            "motor4": cs.motor4, "motor5": cs.motor5, "motor6": cs.motor6
-        }
-    else:
-        # fallback zeros
-        commands = {f"motor{i}":0 for i in range(1,7)}
-
-    return render_template_string(INDEX_HTML,
-                                  thresholds=THRESHOLDS,
-                                  commands=commands,
-                                  username=session.get('username','User'),
-                                  role=session.get('role','patient'))
+    # commands dict guaranteed: the cache starts zeroed and mirrors the DB row
+    commands = dict(_cached_commands)
+
+    return INDEX_TMPL.render(thresholds=THRESHOLDS,
+                             commands=commands,
+                             username=session.get('username','User'),
+                             role=session.get('role','patient'))
 
 # ----- Device & dashboard APIs -----
 @app.route('/update_data', methods=['POST'])
@@ -148,61 +340,106 @@ def update_data():
     if not data:
         return jsonify({"error":"invalid json"}), 400
 
-    sample = {
-        "ts": int(time.time()*1000),
-        "emg": float(data.get("emg",0) or 0),
-        "accel_x": float(data.get("accel_x",0) or 0),
-        "accel_y": float(data.get("accel_y",0) or 0),
-        "accel_z": float(data.get("accel_z",0) or 0),
-        "gyro_x": float(data.get("gyro_x",0) or 0),
-        "gyro_y": float(data.get("gyro_y",0) or 0),
-        "gyro_z": float(data.get("gyro_z",0) or 0)
-    }
+    get = data.get
+    sample = dict(zip(HIST_KEYS,
+                      (int(time.time()*1000), *(float(get(k) or 0) for k in SAMPLE_KEYS))))
 
-    with lock:
-        sensor_history.append(sample)
-        sd = SensorData(ts=sample['ts'], emg=sample['emg'],
-                        accel_x=sample['accel_x'], accel_y=sample['accel_y'],
-                        accel_z=sample['accel_z'],
-                        gyro_x=sample['gyro_x'], gyro_y=sample['gyro_y'], gyro_z=sample['gyro_z'])
-        db.session.add(sd)
-        db.session.commit()
-
-    alerts = []
-    if sample['emg'] > THRESHOLDS['emg']:
-        alerts.append("High EMG")
-    if abs(sample['accel_x']) > THRESHOLDS['accel']:
-        alerts.append("High Accel X")
-    if abs(sample['gyro_y']) > THRESHOLDS['gyro']:
-        alerts.append("High Gyro Y")
+    history_append(sample)
+    with history_lock:
+        _pending.append(sample)
 
+    alerts = alerts_for(sample['emg'], sample['accel_x'], sample['gyro_y'])
     return jsonify({"status":"ok","alerts":alerts})
 
+@app.route('/update_data_bulk', methods=['POST'])
+def update_data_bulk():
+    # backlog flush after a device reconnect: whole batch in one transaction
+    # via executemany instead of a commit per row
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, list) or not data:
+        return jsonify({"error":"expected non-empty json list"}), 400
+    now = int(time.time()*1000)
+    rows = []
+    for item in data:
+        if not isinstance(item, dict):
+            return jsonify({"error":"expected list of objects"}), 400
+        get = item.get
+        try:
+            rows.append(dict(zip(HIST_KEYS,
+                                 (int(get("ts") or now), *(float(get(k) or 0) for k in SAMPLE_KEYS)))))
+        except (TypeError, ValueError):
+            return jsonify({"error":"non-numeric value in sample"}), 400
+    db.session.execute(SENSOR_INSERT, rows)
+    db.session.commit()
+    for sample in rows:
+        history_append(sample)
+    return jsonify({"status":"ok","inserted":len(rows)})
+
+# Serialized /get_data body, reused verbatim while nothing has changed. With
+# several dashboards polling faster than samples arrive, most polls become a
+# cached-bytes send (or a 304) instead of a fresh copy-and-encode pass.
+_resp_lock = threading.Lock()
+_resp_cache = {"etag": None, "body": b""}
+
 @app.route('/get_data', methods=['GET'])
 @login_required
 def get_data():
-    with lock:
-        history = list(sensor_history)
-        latest = history[-1] if history else {"ts":int(time.time()*1000),"emg":0,"accel_x":0,"accel_y":0,"accel_z":0,"gyro_x":0,"gyro_y":0,"gyro_z":0}
-        cs = CommandState.query.first()
-        cmds = {"motor1":cs.motor1,"motor2":cs.motor2,"motor3":cs.motor3,"motor4":cs.motor4,"motor5":cs.motor5,"motor6":cs.motor6} if cs else {f"motor{i}":0 for i in range(1,7)}
-        notes_q = TherapistNote.query.order_by(TherapistNote.ts.desc()).limit(10).all()
-        notes_out = [{"ts":n.ts,"author":n.author,"note":n.note} for n in notes_q]
-
-    alerts=[]
-    if latest.get("emg",0) > THRESHOLDS['emg']: alerts.append("High EMG")
-    if abs(latest.get("accel_x",0)) > THRESHOLDS['accel']: alerts.append("High Accel X")
-    if abs(latest.get("gyro_y",0)) > THRESHOLDS['gyro']: alerts.append("High Gyro Y")
-
-    return jsonify({"history":history,"latest":latest,"commands":cmds,"notes":notes_out,"alerts":alerts})
+    note_ts = _cached_notes[0]["ts"] if _cached_notes else 0
+    etag = f"{latest_ts()}-{note_ts}-{_cmd_version}"
+
+    with _resp_lock:
+        body = _resp_cache["body"] if _resp_cache["etag"] == etag else None
+
+    if body is None:
+        arrs = history_arrays()
+        if arrs["ts"].size:
+            latest = {k: arrs[k][-1].item() for k in HIST_KEYS}
+        else:
+            latest = {"ts":int(time.time()*1000),"emg":0,"accel_x":0,"accel_y":0,"accel_z":0,"gyro_x":0,"gyro_y":0,"gyro_z":0}
+        alerts = alerts_for(latest.get("emg",0), latest.get("accel_x",0), latest.get("gyro_y",0))
+        body = orjson.dumps({"history":arrs,"latest":latest,"commands":dict(_cached_commands),
+                             "notes":list(_cached_notes)[:10],
+                             "alerts":alerts,"window_alerts":window_alerts(arrs)},
+                            option=orjson.OPT_SERIALIZE_NUMPY)
+        with _resp_lock:
+            _resp_cache["etag"], _resp_cache["body"] = etag, body
+
+    # idle dashboards re-poll identical data; the ETag turns those
+    # round-trips into empty 304s
+    resp = app.response_class(body, mimetype='application/json')
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
 
 @app.route('/get_command', methods=['GET'])
 def get_command():
     # public endpoint for ESP32 to poll motor positions
-    cs = CommandState.query.first()
-    if not cs:
-        return jsonify({f"motor{i}":0 for i in range(1,7)})
-    return jsonify({"motor1":cs.motor1,"motor2":cs.motor2,"motor3":cs.motor3,"motor4":cs.motor4,"motor5":cs.motor5,"motor6":cs.motor6})
+    return jsonify(dict(_cached_commands))
+
+# Dragging a slider can fire many POSTs per second; commands take effect in
+# the cache immediately while the DB write is debounced so a burst of
+# updates settles into a single UPDATE + fsync.
+CMD_DEBOUNCE_S = 0.2
+_cmd_timer = None
+_cmd_timer_lock = threading.Lock()
+
+def _flush_commands():
+    with app.app_context():
+        cs = get_command_state()
+        if cs is None:
+            cs = CommandState()
+            db.session.add(cs)
+        for k, v in _cached_commands.items():
+            setattr(cs, k, v)
+        db.session.commit()
+
+def schedule_command_flush():
+    global _cmd_timer
+    with _cmd_timer_lock:
+        if _cmd_timer is not None:
+            _cmd_timer.cancel()
+        _cmd_timer = threading.Timer(CMD_DEBOUNCE_S, _flush_commands)
+        _cmd_timer.daemon = True
+        _cmd_timer.start()
 
 @app.route('/set_command', methods=['POST'])
 @login_required
@@ -213,16 +450,13 @@ def set_command():
     data = request.get_json(force=True, silent=True)
     if not data:
         return jsonify({"error":"no json"}), 400
-    cs = CommandState.query.first()
-    if not cs:
-        cs = CommandState()
-        db.session.add(cs)
     changed = False
     if 'motor_all' in data:
         try:
             a = int(float(data['motor_all']))
             a = max(0,min(180,a))
-            cs.motor1 = cs.motor2 = cs.motor3 = cs.motor4 = cs.motor5 = cs.motor6 = a
+            for i in range(1,7):
+                _cached_commands[f"motor{i}"] = a
             changed = True
         except:
             pass
@@ -232,13 +466,15 @@ def set_command():
             try:
                 a = int(float(data[key]))
                 a = max(0,min(180,a))
-                setattr(cs, key, a)
+                _cached_commands[key] = a
                 changed = True
             except:
                 pass
     if changed:
-        db.session.commit()
-    return jsonify({"status":"ok","commands":{"motor1":cs.motor1,"motor2":cs.motor2,"motor3":cs.motor3,"motor4":cs.motor4,"motor5":cs.motor5,"motor6":cs.motor6}})
+        global _cmd_version
+        _cmd_version += 1
+        schedule_command_flush()
+    return jsonify({"status":"ok","commands":dict(_cached_commands)})
 
 @app.route('/save_note', methods=['POST'])
 @login_required
@@ -252,16 +488,16 @@ def save_note():
     text = data.get('note','').strip()
     if not text:
         return jsonify({"error":"empty note"}), 400
-    n = TherapistNote(ts=int(time.time()*1000), author=author, note=text)
-    db.session.add(n)
+    row = {"ts": int(time.time()*1000), "author": author, "note": text}
+    db.session.execute(NOTE_INSERT, [row])
     db.session.commit()
-    return jsonify({"status":"saved","note":{"ts":n.ts,"author":n.author,"note":n.note}})
+    _cached_notes.appendleft(row)
+    return jsonify({"status":"saved","note":row})
 
 @app.route('/get_notes', methods=['GET'])
 @login_required
 def get_notes():
-    notes = TherapistNote.query.order_by(TherapistNote.ts.desc()).limit(50).all()
-    return jsonify([{"ts":n.ts,"author":n.author,"note":n.note} for n in notes])
+    return jsonify(list(_cached_notes))
 
 # ----- Templates -----
 # (Unchanged visually from your previous version; defensive Jinja usage applied.)
@@ -554,11 +790,32 @@ setInterval(poll, POLL_MS);
 </html>
 """
 
+# Compile the inline templates once at import. render_template_string()
+# re-tokenizes the whole page on every request; a precompiled Template only
+# pays for the render phase.
+LOGIN_TMPL = app.jinja_env.from_string(LOGIN_HTML)
+REGISTER_TMPL = app.jinja_env.from_string(REGISTER_HTML)
+INDEX_TMPL = app.jinja_env.from_string(INDEX_HTML)
+
 # ----- Startup -----
 with app.app_context():
+    enable_sqlite_wal()
     db.create_all()
+    # create_all() does not alter pre-existing tables, so backfill the ts
+    # indexes on databases created before they were declared on the models
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_sensor_data_ts ON sensor_data (ts)"))
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_therapist_note_ts ON therapist_note (ts)"))
+    db.session.commit()
     ensure_command_row()
+load_caches()
+start_flusher()
+start_sweeper()
 
 if __name__ == "__main__":
-    # debug=True is convenient for development; turn off in production
+    # Development only. In production run under gunicorn (see Procfile):
+    #     gunicorn -k gthread -w 1 --threads 8 app:app
+    # One worker, many threads: the history ring, command/note caches and
+    # flusher live in process memory, so extra workers would each see only
+    # their own slice of the data. Threads overlap fine thanks to WAL and
+    # per-thread pooled connections.
     app.run(host="0.0.0.0", port=APP_PORT, debug=True)